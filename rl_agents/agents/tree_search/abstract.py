@@ -308,8 +308,11 @@ class Node(object):
         :param x: an array
         :return: a random index among the maximums
         """
-        indices = Node.all_argmax(x)
-        return self.planner.np_random.choice(indices)
+        x = np.asarray(x)
+        indices = np.flatnonzero(x == x.max())
+        if indices.size == 1:
+            return indices[0]
+        return indices[self.planner.np_random.randint(indices.size)]
 
     def __str__(self):
         return "{} (n:{}, v:{:.2f})".format(list(self.path()), self.count, self.get_value())
@@ -9,6 +9,17 @@ from rl_agents.agents.tree_search.abstract import Node, AbstractTreeSearchAgent,
 logger = logging.getLogger(__name__)
 
 
+def observation_key(observation):
+    """
+        A hashable key identifying an observation.
+
+        Arrays are identified by their raw bytes, which is much cheaper than formatting them as strings.
+    :param observation: an observation
+    :return: the observation key
+    """
+    return observation.tobytes() if isinstance(observation, np.ndarray) else str(observation)
+
+
 class GraphNode(Node):
     def __init__(self, planner, state, observation):
         super().__init__(parent=None, planner=planner)
@@ -94,7 +105,7 @@ class GraphBasedPlanner(AbstractPlanner):
         self.root = GraphNode(planner=self, state=None, observation=None)
 
     def run(self, observation):
-        node = self.nodes[str(observation)]
+        node = self.nodes[observation_key(observation)]
         for k in range(self.config["sampling_timeout"]):
             if not node.children:
                 node.expand()
@@ -107,13 +118,23 @@ class GraphBasedPlanner(AbstractPlanner):
             logger.info("The optimistic sampling strategy could not find a sink. We probably found an optimal loop.")
             self.observations.extend([node.observation] * node.state.action_space.n)
 
-    def get_node(self, observation, state=None):
-        # Get or create node
-        if str(observation) not in self.nodes:
-            self.nodes[str(observation)] = self.NODE_TYPE(self, state, observation)
-        if state is not None and self.nodes[str(observation)].state is None:
-            self.nodes[str(observation)].state = state
-        return self.nodes[str(observation)]
+    def get_node(self, observation, state=None, key=None):
+        """
+            Get or create the node of an observation.
+
+        :param observation: an observation
+        :param state: the corresponding environment state, if available
+        :param key: the observation key, if already computed
+        :return: the node
+        """
+        if key is None:
+            key = observation_key(observation)
+        node = self.nodes.get(key)
+        if node is None:
+            node = self.nodes[key] = self.NODE_TYPE(self, state, observation)
+        if state is not None and node.state is None:
+            node.state = state
+        return node
 
     def plan(self, state, observation):
         self.root = self.get_node(observation, state=state)
@@ -1,16 +1,34 @@
+import math
 import operator
-from collections import OrderedDict, defaultdict
+import os
+import re
+import threading
+from collections import OrderedDict, defaultdict, deque
+from multiprocessing.pool import Pool, ThreadPool
 
+import gym
 import numpy as np
 import logging
 from rl_agents.agents.common.factory import safe_deepcopy_env
 from rl_agents.agents.dynamic_programming.value_iteration import ValueIterationAgent
-from rl_agents.agents.tree_search.graph_based import GraphBasedPlannerAgent, GraphNode, GraphBasedPlanner
+from rl_agents.agents.tree_search.graph_based import GraphBasedPlannerAgent, GraphNode, GraphBasedPlanner, \
+    observation_key
 from rl_agents.agents.tree_search.olop import OLOP
-from rl_agents.utils import kl_upper_bound, max_expectation_under_constraint
+from rl_agents.utils import kl_upper_bound, max_expectation_under_constraint_jit, near_split, zip_with_singletons
 
 logger = logging.getLogger(__name__)
 
+SCALAR_TYPES = (type(None), bool, int, float, str, np.number)
+
+SNAPSHOT_METHODS = [("get_state", "set_state"), ("clone_full_state", "restore_full_state")]
+""" Pairs of environment methods (save, restore) that save and restore the whole dynamics of an environment """
+
+TRANSITION_BOUNDS_ACCURACY = 1e-2
+""" Accuracy on the KL constraint when solving for the optimistic and pessimistic transition probabilities """
+
+VALUE_ITERATION_MAX_PASSES = 100
+""" Maximum number of updates per node in a partial value iteration, on average """
+
 
 class GraphDecisionNode(GraphNode):
     """
@@ -38,6 +56,18 @@ class GraphDecisionNode(GraphNode):
         """ Upper bound on mean r(s,a,s') (when child of a chance node). """
         self.mu_lcb = 0
         """ Lower bound on mean r(s,a,s') (when child of a chance node)"""
+        self.bounds_count = 0
+        """ Visit count at the last computation of mu_ucb and mu_lcb """
+        self.slot = None
+        """ Index of (s,a,s') in the statistics arrays of its parent chance node (when child of a chance node)"""
+        self.representative = None
+        """ Node of s' in planner.nodes, once looked up (when child of a chance node)"""
+        self.actions = []
+        """ Available actions a, in the order of self.chance_nodes """
+        self.chance_nodes = []
+        """ Chance nodes (s,a), also stored in self.children but indexed like self.actions """
+        self.q_lower, self.q_upper = None, None
+        """ Action-values bounds at the last value iteration update, raised by the updates skipped since """
 
     def sampling_rule(self):
         """
@@ -46,63 +76,135 @@ class GraphDecisionNode(GraphNode):
         if not self.children:
             self.expand()
         q_values_upper = self.backup("value_upper")
-        actions = list(q_values_upper.keys())
-        index = self.random_argmax(list(q_values_upper.values()))
-        return actions[index]
+        # Penalize actions currently explored by other rollouts
+        virtual_loss = self.planner.virtual_loss
+        if virtual_loss:
+            q_values_upper -= virtual_loss * np.array([c.virtual_loss for c in self.chance_nodes])
+        return self.actions[self.random_argmax(q_values_upper)]
 
     def selection_rule(self):
         """
             Conservative action selection
         """
         q_values_lower = self.backup("value_lower")
-        actions = list(q_values_lower.keys())
-        index = self.random_argmax(list(q_values_lower.values()))
-        return actions[index]
+        return self.actions[self.random_argmax(q_values_lower)]
 
-    def update(self, reward=None):
-        self.count += 1
+    def update(self, reward=None, count=1):
+        """
+            Update the visit statistics of the node.
+
+        :param reward: the sum of rewards r(s,a,s') received over these visits, if any
+        :param count: the number of visits
+        """
+        self.count += count
         if reward is not None:
             self.cumulative_reward += reward
             self.compute_reward_ucb()
+        if self.slot is not None:
+            self.parent.next_counts[self.slot] = self.count
+            self.parent.next_mu_ucb[self.slot] = self.mu_ucb
+            self.parent.next_mu_lcb[self.slot] = self.mu_lcb
 
     def compute_reward_ucb(self):
-        if self.planner.config["upper_bound"]["type"] == "kullback-leibler":
-            # Variables available for threshold evaluation
-            horizon = self.planner.config["horizon"]
-            actions = self.planner.env.action_space.n
-            count = self.count
-            time = self.planner.config["episodes"]
-            threshold = eval(self.planner.config["upper_bound"]["threshold"])
+        # Rewards are in [0, 1], so the empirical mean has moved by at most (count - bounds_count) / count since the
+        # last computation: skip it if this is below accuracy, unless recompute_every visits have been made
+        new_visits = self.count - self.bounds_count
+        if new_visits < self.planner.recompute_every and new_visits <= self.planner.accuracy * self.count:
+            return
+        self.bounds_count = self.count
+        if self.planner.ub_type == "kullback-leibler":
+            threshold = self.planner.reward_threshold(horizon=self.planner.horizon,
+                                                      actions=self.planner.env.action_space.n,
+                                                      count=self.count,
+                                                      time=self.planner.episodes)
             if threshold == 0:
                 self.mu_ucb = self.mu_lcb = self.cumulative_reward / self.count
             else:
-                self.mu_ucb = kl_upper_bound(self.cumulative_reward, self.count, 0,
-                                             threshold=str(threshold))
-                self.mu_lcb = kl_upper_bound(self.cumulative_reward, self.count, 0,
-                                             threshold=str(threshold), lower=True)
+                self.mu_ucb = kl_upper_bound(self.cumulative_reward, self.count, threshold)
+                self.mu_lcb = kl_upper_bound(self.cumulative_reward, self.count, threshold, lower=True)
         else:
             logger.error("Unknown upper-bound type")
 
     def backup(self, field):
-        return {action: chance_node.backup(field) for action, chance_node in self.children.items()}
+        """
+        :param field: the value bound to back up
+        :return: the array of action-values bounds Q(s, a), indexed like self.actions
+        """
+        return np.fromiter((chance_node.backup(field) for chance_node in self.chance_nodes), dtype=np.float64,
+                           count=len(self.chance_nodes))
+
+    def backup_both(self):
+        """
+            Back up both value bounds at once, see backup().
+
+        :return: the arrays of action-values lower and upper bounds, indexed like self.actions
+        """
+        bounds = np.array([chance_node.backup_both() for chance_node in self.chance_nodes], dtype=np.float64)
+        return bounds[:, 0], bounds[:, 1]
 
     def partial_value_iteration(self, queue=None):
-        if queue is None:
-            queue = [self]
-        while queue:
-            node = queue.pop(0)
-            delta = 0
-            for field in ["value_lower", "value_upper"]:
-                action_value = node.backup(field)  # Q(s, a)
-                state_value_bound = np.amax(list(action_value.values()))
-                delta = max(delta, abs(getattr(node, field) - state_value_bound))
-                setattr(node, field, state_value_bound)
-            if delta > self.planner.config["accuracy"]:
-                queue.extend(list(node.parents))
+        queue = deque([self] if queue is None else queue)
+        queued = set(queue)  # A node waiting in the queue will be updated only once
+        max_updates = VALUE_ITERATION_MAX_PASSES * max(len(self.planner.nodes), len(queue))
+        for _ in range(max_updates):
+            if not queue:
+                break
+            node = queue.popleft()
+            queued.discard(node)
+            node.q_lower, node.q_upper = node.backup_both()  # Q(s, a)
+            value_lower, value_upper = np.amax(node.q_lower), np.amax(node.q_upper)
+            delta_lower, delta_upper = value_lower - node.value_lower, value_upper - node.value_upper
+            node.value_lower, node.value_upper = value_lower, value_upper
+            if max(abs(delta_lower), abs(delta_upper)) > self.planner.accuracy:
+                for parent in node.parents:
+                    if parent not in queued and parent.value_may_change(node, delta_lower, delta_upper):
+                        queued.add(parent)
+                        queue.append(parent)
+        else:
+            if queue:
+                logger.info("The partial value iteration did not converge after {} updates".format(max_updates))
+
+    def value_may_change(self, node, delta_lower, delta_upper):
+        """
+            Whether the value bounds of this node may change after the value bounds of a next state have changed.
+
+            Action-values are gamma-Lipschitz in the next state values, so the change can only matter for a maximizing
+            action, or for an action whose value may be raised up to the maximum. Otherwise, the update is skipped and
+            the cached action-values are raised accordingly.
+
+        :param node: the next state node
+        :param delta_lower: the change of its value lower bound
+        :param delta_upper: the change of its value upper bound
+        :return: whether this node should be updated
+        """
+        if self.q_lower is None or self.q_lower.size != len(self.chance_nodes):
+            return True
+        gamma, accuracy = self.planner.gamma, self.planner.accuracy
+        may_change = False
+        for i, chance_node in enumerate(self.chance_nodes):
+            if any(child.representative is node for child in chance_node.next_nodes[:chance_node.observed_count]):
+                self.q_lower[i] += gamma * max(delta_lower, 0)
+                self.q_upper[i] += gamma * max(delta_upper, 0)
+                # Changes below accuracy are not propagated, hence not accounted for in q: keep a margin
+                may_change |= self.q_lower[i] + accuracy >= self.value_lower \
+                    or self.q_upper[i] + accuracy >= self.value_upper
+        return may_change
 
     def expand(self):
         for action in self.actions_list():
-            self.children[action] = GraphChanceNode(self.planner, parent=self)
+            self.add_chance_node(action)
+
+    def add_chance_node(self, action):
+        """
+            Add the chance node (s,a) of an action.
+
+        :param action: an action
+        :return: the chance node
+        """
+        chance_node = self.children[action] = GraphChanceNode(self.planner, parent=self)
+        self.actions.append(action)
+        self.chance_nodes.append(chance_node)
+        return chance_node
 
     def actions_list(self):
         if self.state is None:
@@ -117,11 +219,15 @@ class GraphDecisionNode(GraphNode):
 
     def get_field(self, field):
         """ In case this nodes encodes the transition (s,a,s'), return the estimate of the s' state representative."""
-        if str(self.observation) in self.planner.nodes:
-            representative = self.planner.nodes[str(self.observation)]
-            return getattr(representative, field)
-        else:
-            return getattr(self, field)
+        if self.representative is None:
+            self.representative = self.planner.nodes.get(observation_key(self.observation), self)
+        return getattr(self.representative, field)
+
+    def get_bounds(self):
+        """ Same as get_field(), for both value bounds: return (value_lower, value_upper)."""
+        if self.representative is None:
+            self.representative = self.planner.nodes.get(observation_key(self.observation), self)
+        return self.representative.value_lower, self.representative.value_upper
 
     def __str__(self):
         return "{} (L:{:.2f}, U:{:.2f})".format(str(self.observation), self.value_lower, self.value_upper)
@@ -139,84 +245,160 @@ class GraphChanceNode(GraphNode):
         self.parent = parent
         self.count = 0
         """ Visit count N(s, a) (when in planner.nodes) or N(s,a,s') (when child of a chance node)"""
+        self.virtual_loss = 0
+        """ Number of rollouts currently performing the transition (s, a)"""
 
         self.p_hat, self.p_plus, self.p_minus = None, None, None
+        self.cdf_plus, self.cdf_minus = None, None
+        """ Cumulative distributions of p_plus and p_minus, computed when sampling """
 
-        # Generate placeholder nodes
+        # Unobserved next states all share the planner placeholder node, until they are observed
         self.children = OrderedDict()
+        self.next_nodes = []
+        """ Next state nodes (s,a,s'), indexed by slot """
+        self.next_states = []
+        """ Keys of the next state nodes in self.children, indexed by slot """
+        self.observed_count = 0
+        """ Number of slots already assigned to an observed next state """
         for i in range(self.planner.config["max_next_states_count"]):
-            self.children["placeholder_{}".format(i)] = GraphDecisionNode(self.planner,
-                                                                          state=None,
-                                                                          observation="placeholder")
-
-    def selection_rule(self):
+            self.children["placeholder_{}".format(i)] = self.planner.placeholder
+            self.next_nodes.append(self.planner.placeholder)
+            self.next_states.append("placeholder_{}".format(i))
+
+        # Statistics of the next state nodes, indexed by slot, stored in single precision
+        self.next_counts = np.zeros(len(self.next_nodes), dtype=np.int32)
+        self.next_mu_ucb = np.ones(len(self.next_nodes), dtype=np.float32)
+        self.next_mu_lcb = np.zeros(len(self.next_nodes), dtype=np.float32)
+        # Buffers for the next state values bounds, in double precision for the transition bounds solver
+        self.u_next = np.zeros(len(self.next_nodes))
+        self.l_next = np.zeros(len(self.next_nodes))
+
+    def selection_rule(self, u=None):
         """
             Sample state under the conservative distribution
+
+        :param u: a uniform random number in [0, 1), drawn from the planner generator if not provided
+        :return: the next state key
         """
-        return self.planner.np_random.choice(list(self.children.keys()), p=self.p_minus)
+        if self.cdf_minus is None:
+            self.cdf_minus = np.cumsum(self.p_minus)
+        return self.next_states[self.sample_index(self.cdf_minus, u)]
 
-    def sampling_rule(self):
+    def sampling_rule(self, u=None):
         """
-            Sample state under the conservative distribution
+            Sample state under the optimistic distribution
+
+        :param u: a uniform random number in [0, 1), drawn from the planner generator if not provided
+        :return: the next state key
+        """
+        if self.cdf_plus is None:
+            self.cdf_plus = np.cumsum(self.p_plus)
+        return self.next_states[self.sample_index(self.cdf_plus, u)]
+
+    def sample_index(self, cdf, u=None):
+        """
+            Inverse transform sampling of an index from a cumulative distribution.
+
+        :param cdf: the cumulative distribution
+        :param u: a uniform random number in [0, 1), drawn from the planner generator if not provided
+        :return: the sampled index
         """
-        return self.planner.np_random.choice(self.children, p=self.p_plus)
+        if u is None:
+            u = self.planner.np_random.random_sample()
+        return min(int(np.searchsorted(cdf, u * cdf[-1], side="right")), cdf.size - 1)
 
-    def update(self):
-        self.count += 1
+    def update(self, count=1):
+        self.count += count
 
     def backup(self, field):
         """
             Bellman Q(s,a) = r(s,a) + gamma E_s' V(s')
         """
         if self.count == 0:
-            self.next_states = list(self.children.keys())
-            self.p_plus = self.p_minus = np.ones((len(self.children),))/len(self.children)
+            self.p_plus = self.p_minus = np.ones((len(self.next_nodes),))/len(self.next_nodes)
+            self.cdf_plus = self.cdf_minus = None
             return self.value_upper if field == "value_upper" else self.value_lower
 
-        gamma = self.planner.config["gamma"]
-        self.p_hat = np.array([child.count for child in self.children.values()]) / self.count
-        self.next_states = list(self.children.keys())
-        threshold = self.transition_threshold() / self.count
-
+        threshold = self.update_p_hat()
+        v_next = np.fromiter((c.get_field(field) for c in self.next_nodes), dtype=np.float64,
+                             count=len(self.next_nodes))
         if field == "value_upper":
-            u_next = np.zeros((len(self.children),))
-            for i, c in enumerate(self.children.values()):
-                v_n = self.planner.nodes[str(c.observation)].value_upper \
-                    if str(c.observation) != "placeholder" else 1 / (1-gamma)
-                u_next[i] = c.mu_ucb + gamma * v_n
-            self.p_plus = max_expectation_under_constraint(u_next, self.p_hat, threshold)
-            self.value_upper = self.p_plus @ u_next
-            return self.value_upper
+            return self.backup_upper(v_next, threshold)
         elif field == "value_lower":
-            l_next = np.zeros((len(self.children),))
-            for i, c in enumerate(self.children.values()):
-                v_n = self.planner.nodes[str(c.observation)].value_lower \
-                    if str(c.observation) != "placeholder" else 0
-                l_next[i] = c.mu_ucb + gamma * v_n
-            self.p_minus = max_expectation_under_constraint(-l_next, self.p_hat, threshold)
-            self.value_lower = self.p_minus @ l_next
-            return self.value_lower
+            return self.backup_lower(v_next, threshold)
+
+    def backup_both(self):
+        """
+            Back up both value bounds in a single pass over the next states, see backup().
+
+        :return: the tuple (value_lower, value_upper)
+        """
+        if self.count == 0:
+            self.p_plus = self.p_minus = np.ones((len(self.next_nodes),))/len(self.next_nodes)
+            self.cdf_plus = self.cdf_minus = None
+            return self.value_lower, self.value_upper
+
+        threshold = self.update_p_hat()
+        v_next = np.array([c.get_bounds() for c in self.next_nodes], dtype=np.float64)
+        return self.backup_lower(v_next[:, 0], threshold), self.backup_upper(v_next[:, 1], threshold)
+
+    def update_p_hat(self):
+        """
+            Update the empirical transition distribution.
+
+        :return: the KL radius of the confidence region around it
+        """
+        self.p_hat = self.next_counts / self.count
+        return self.transition_threshold() / self.count
+
+    def backup_upper(self, v_next, threshold):
+        u_next = np.multiply(v_next, self.planner.gamma, out=self.u_next)
+        u_next += self.next_mu_ucb
+        self.p_plus = max_expectation_under_constraint_jit(u_next, self.p_hat, threshold,
+                                                           TRANSITION_BOUNDS_ACCURACY)
+        self.cdf_plus = None
+        self.value_upper = self.p_plus @ u_next
+        return self.value_upper
+
+    def backup_lower(self, v_next, threshold):
+        l_next = np.multiply(v_next, self.planner.gamma, out=self.l_next)
+        l_next += self.next_mu_lcb
+        self.p_minus = max_expectation_under_constraint_jit(-l_next, self.p_hat, threshold,
+                                                            TRANSITION_BOUNDS_ACCURACY)
+        self.cdf_minus = None
+        self.value_lower = self.p_minus @ l_next
+        return self.value_lower
 
     def transition_threshold(self):
-        horizon = self.planner.config["horizon"]
-        actions = self.planner.env.action_space.n
-        count = self.count
-        time = self.planner.config["episodes"]
-        return eval(self.planner.config["upper_bound"]["transition_threshold"])
-
-    def get_child(self, observation):
-        if str(observation) not in self.children:
-            # Assign the first available placeholder to the observation
-            for i in range(self.planner.config["max_next_states_count"]):
-                if "placeholder_{}".format(i) in self.children:
-                    self.children[str(observation)] = self.children.pop("placeholder_{}".format(i))
-                    self.children[str(observation)].observation = observation
-                    self.planner.get_node(observation).parents.add(self.parent)
-                    break
-            else:
+        return self.planner.transition_threshold(horizon=self.planner.horizon,
+                                                 actions=self.planner.env.action_space.n,
+                                                 count=self.count,
+                                                 time=self.planner.episodes)
+
+    def get_child(self, observation, key=None):
+        """
+        :param observation: a next state observation
+        :param key: the observation key, if already computed
+        :return: the next state node
+        """
+        if key is None:
+            key = observation_key(observation)
+        child = self.children.get(key)
+        if child is None:
+            # Assign the first available slot to the observation
+            i = self.observed_count
+            if i >= len(self.next_nodes):
                 raise ValueError("No more placeholder nodes available, we observed more next states than "
                                  "the 'max_next_states_count' config")
-        return self.children[str(observation)]
+            del self.children[self.next_states[i]]
+            child = self.children[key] = self.next_nodes[i] = \
+                GraphDecisionNode(self.planner, state=None, observation=observation)
+            child.parent, child.slot = self, i
+            child.representative = self.planner.get_node(observation, key=key)
+            child.representative.parents.add(self.parent)
+            self.next_states[i] = key
+            self.observed_count += 1
+        return child
 
     def __str__(self):
         return "{} (L:{:.2f}, U:{:.2f})".format(id(self), self.value_lower, self.value_upper)
@@ -225,47 +407,91 @@ class GraphChanceNode(GraphNode):
         return self.__str__()
 
 
+def threshold_function(expression):
+    """
+        Build a function evaluating a threshold expression, such as "1*np.log(time)".
+
+        The expression is parsed once rather than at every evaluation. Expressions of the form "C*np.log(time)" are
+        mapped to scalar arithmetic, and other expressions are compiled to bytecode.
+
+    :param expression: a threshold expression of the variables horizon, actions, count and time
+    :return: a function (horizon, actions, count, time) -> threshold
+    """
+    match = re.fullmatch(r"\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*\*\s*np\.log\(\s*time\s*\)\s*", expression)
+    if match:
+        c = float(match.group(1))
+        return lambda horizon, actions, count, time: c * math.log(time)
+    code = compile(expression, "<threshold>", "eval")
+    return lambda horizon, actions, count, time: eval(code, globals(), dict(horizon=horizon, actions=actions,
+                                                                            count=count, time=time))
+
+
 class StochasticGraphBasedPlanner(GraphBasedPlanner):
     NODE_TYPE = GraphDecisionNode
 
     def __init__(self, env, config=None):
         super().__init__(env, config)
-
-    def run(self, state, observation):
+        self.reward_threshold = threshold_function(self.config["upper_bound"]["threshold"])
+        self.transition_threshold = threshold_function(self.config["upper_bound"]["transition_threshold"])
+        self.pool = None
+        """ Pool of workers for root parallelization, created when first needed """
+        self.lock = threading.Lock()
+        """ Protects the graph when several rollouts run concurrently """
+        self.placeholder = GraphDecisionNode(self, state=None, observation="placeholder")
+        """ Unvisited node standing for all the next states that were not observed yet """
+        self.placeholder.representative = self.placeholder
+
+    def run(self, states, observation):
         """
-        :param state: the initial environment state
+        :param states: the initial environment states, one for each trajectory to sample simultaneously
+        :param observation: the corresponding state observation
         """
-        # We need randomness
-        state.seed(self.np_random.randint(2**30))
+        observations = [observation] * len(states)
+        keys = [observation_key(observation)] * len(states)
         if self.root.children:
             logger.debug(" / ".join(["a{} ({}): [{:.3f}, {:.3f}]".format(k, n.count, n.value_lower, n.value_upper)
                                      for k, n in self.root.children.items()]))
-        update_queue = []
+        update_queue, updated_nodes = [], set()
         # Follow sampling rule, expand graph if needed, collect rewards and update confidence bounds.
-        for h in range(self.config["horizon"]):
-            decision_node = self.get_node(observation, state)
-            action = decision_node.sampling_rule()
-            chance_node = decision_node.get_child(action)
-
-            # Perform transition
-            observation, reward, done, _ = self.step(state, action)
-            next_decision_node = chance_node.get_child(observation)
-
-            # Update local statistics
-            decision_node.update()
-            chance_node.update()
-            next_decision_node.update(reward)
-
-            # matrix version only
-            # chance_node.backup("value_upper")
-            # chance_node.backup("value_lower")
-
-            # Track updated nodes
-            if decision_node not in update_queue:
-                update_queue.append(decision_node)
+        for h in range(self.horizon):
+            # Virtual losses make trajectories sharing a node follow different actions
+            with self.lock:
+                transitions = []
+                for state, observation, key in zip(states, observations, keys):
+                    decision_node = self.get_node(observation, state, key)
+                    action = decision_node.sampling_rule()
+                    chance_node = decision_node.get_child(action)
+                    chance_node.virtual_loss += 1
+                    transitions.append((decision_node, action, chance_node))
+
+            # Perform transitions
+            steps = [self.step(state, action) for state, (_, action, _) in zip(states, transitions)]
+            observations = [observation for observation, _, _, _ in steps]
+            keys = [observation_key(observation) for observation in observations]
+
+            with self.lock:
+                for (decision_node, _, chance_node), (observation, reward, _, _), key \
+                        in zip(transitions, steps, keys):
+                    next_decision_node = chance_node.get_child(observation, key)
+                    chance_node.virtual_loss -= 1
+
+                    # Update local statistics
+                    decision_node.update()
+                    chance_node.update()
+                    next_decision_node.update(reward)
+
+                    # matrix version only
+                    # chance_node.backup("value_upper")
+                    # chance_node.backup("value_lower")
+
+                    # Track updated nodes
+                    if decision_node not in updated_nodes:
+                        updated_nodes.add(decision_node)
+                        update_queue.append(decision_node)
 
         # Value iteration
-        decision_node.partial_value_iteration(queue=list(reversed(update_queue)))
+        with self.lock:
+            decision_node.partial_value_iteration(queue=list(reversed(update_queue)))
         # self.matrix_value_iteration()
 
 
@@ -279,7 +505,7 @@ class StochasticGraphBasedPlanner(GraphBasedPlanner):
         self.reward_upper = np.zeros((state_size, action_size, state_size))
         self.reward_lower = np.zeros((state_size, action_size, state_size))
 
-        value_upper = np.ones(state_size) / (1 - self.config["gamma"])
+        value_upper = np.ones(state_size) / (1 - self.gamma)
         value_lower = np.zeros(state_size)
         if hasattr(self, "value_upper"):
             value_upper[:self.value_upper.size] = self.value_upper
@@ -311,12 +537,12 @@ class StochasticGraphBasedPlanner(GraphBasedPlanner):
                 self.nodes[obs].value_upper = self.value_upper[index]
 
     def bellman_operator_upper(self, value):
-        q = (self.transition_upper * (self.reward_upper + self.config["gamma"] * value.reshape((1, 1, value.size)))).sum(axis=-1)
+        q = (self.transition_upper * (self.reward_upper + self.gamma * value.reshape((1, 1, value.size)))).sum(axis=-1)
         v = q.max(axis=-1)
         return v
 
     def bellman_operator_lower(self, value):
-        q = (self.transition_lower * (self.reward_lower + self.config["gamma"] * value.reshape((1, 1, value.size)))).sum(axis=-1)
+        q = (self.transition_lower * (self.reward_lower + self.gamma * value.reshape((1, 1, value.size)))).sum(axis=-1)
         v = q.max(axis=-1)
         return v
 
@@ -324,23 +550,208 @@ class StochasticGraphBasedPlanner(GraphBasedPlanner):
         value = initial
         for iteration in range(1000):
             next_value = operator(value)
-            if np.allclose(value, next_value, atol=self.config["accuracy"]):
+            if np.allclose(value, next_value, atol=self.accuracy):
                 break
             value = next_value
         return next_value
 
     def plan(self, state, observation):
         self.root = self.get_node(observation, state=state)
-        for _ in np.arange(self.config["episodes"]):
-            self.run(safe_deepcopy_env(state), observation)
+        processes = self.config["processes"] or os.cpu_count()
+        if processes > 1:
+            self.run_parallel(state, observation, processes)
+        elif self.config["threads"] > 1:
+            self.run_threads(state, observation, self.config["threads"])
+        else:
+            self.run_episodes(state, observation, self.episodes)
 
         return self.get_plan()
 
+    def run_episodes(self, state, observation, episodes):
+        """
+            Run episodes by batches of num_parallel_sims simultaneous trajectories.
+
+        :param state: the initial environment state
+        :param observation: the corresponding state observation
+        :param episodes: the total number of trajectories
+        """
+        batches = near_split(episodes, size_bins=self.config["num_parallel_sims"]) if episodes else []
+        snapshot = self._snapshot(state)
+        states = []
+        for trajectories in batches:
+            previous, states = states, []
+            for i in range(trajectories):
+                state = self._restore(snapshot, previous[i] if i < len(previous) else None)
+                if i >= len(previous) or state is not previous[i]:
+                    self.seed_env(state)  # We need randomness, but only new copies have to be seeded
+                states.append(state)
+            self.run(states, observation)
+
+    def seed_env(self, state):
+        """
+            Seed an environment from the planner random generator.
+
+            The random generator of the environment is replaced directly when possible, which is cheaper than seed().
+
+        :param state: the environment state
+        """
+        seed = self.np_random.randint(2**30)
+        env = getattr(state, "unwrapped", state)
+        if isinstance(getattr(env, "np_random", None), np.random.RandomState):
+            env.np_random = np.random.RandomState(seed)
+        elif isinstance(getattr(env, "np_random", None), np.random.Generator):
+            env.np_random = np.random.default_rng(seed)
+        else:
+            state.seed(seed)
+
+    @staticmethod
+    def _snapshot(state):
+        """
+            Take a snapshot of an environment, from which rollouts can be restarted.
+
+            Environments are deep copied before each rollout by default. They can opt in to a cheaper restoration
+            by providing methods to save and restore their whole dynamics, see SNAPSHOT_METHODS, such as the emulator
+            state of Atari environments. Wrappers are supported as long as their own attributes are scalars.
+
+        :param state: the environment state
+        :return: a tuple (environment, wrappers attributes, dynamics), where the dynamics are a tuple (restoration
+                 method name, saved state), or None if the environment has to be deep copied. The environment itself
+                 is kept as the source of new copies, and must not be stepped while the snapshot is in use.
+        """
+        wrappers, env = [], state
+        while isinstance(env, gym.Wrapper):
+            wrappers.append({k: v for k, v in vars(env).items() if k != "env"})
+            env = env.env
+        if not all(isinstance(v, SCALAR_TYPES) for attributes in wrappers for v in attributes.values()):
+            return state, wrappers, None
+        for save, restore in SNAPSHOT_METHODS:
+            if hasattr(env, save) and hasattr(env, restore):
+                return state, wrappers, (restore, getattr(env, save)())
+        return state, wrappers, None
+
+    @staticmethod
+    def _restore(snapshot, state=None):
+        """
+            Restore an environment to a snapshot.
+
+        :param snapshot: the snapshot, see _snapshot()
+        :param state: an environment previously obtained from this snapshot, to restore in place if possible
+        :return: the restored environment
+        """
+        source, wrappers, dynamics = snapshot
+        if state is None or dynamics is None:
+            return safe_deepcopy_env(source)
+        env = state
+        for attributes in wrappers:
+            vars(env).update(attributes)
+            env = env.env
+        restore, saved_state = dynamics
+        getattr(env, restore)(saved_state)
+        return state
+
+    def run_threads(self, state, observation, threads):
+        """
+            Tree parallelization: several threads run episodes concurrently on the shared graph.
+
+            The graph is only locked while it is traversed or updated, so that the environment transitions of the
+            different rollouts can overlap. A virtual loss is applied to the transitions being performed, so that
+            concurrent rollouts explore different actions.
+
+        :param state: the initial environment state
+        :param observation: the corresponding state observation
+        :param threads: the number of threads
+        """
+        with ThreadPool(processes=threads) as pool:
+            pool.starmap(self.run_episodes, zip_with_singletons(state, observation,
+                                                                near_split(self.episodes, threads)))
+
+    def run_parallel(self, state, observation, processes):
+        """
+            Root parallelization: each worker runs a share of the episodes on its own graph, and the visit statistics
+            of all graphs are merged into this planner before running value iteration on the merged graph.
+
+            The pool of workers is created on the first call, and reused for the next plans.
+
+        :param state: the initial environment state
+        :param observation: the corresponding state observation
+        :param processes: the number of workers
+        """
+        workers_episodes = near_split(self.episodes, processes)
+        workers_seeds = [self.np_random.randint(2**30) for _ in range(processes)]
+        workers_params = list(zip_with_singletons(safe_deepcopy_env(state),
+                                                  observation,
+                                                  self.config,
+                                                  workers_episodes,
+                                                  workers_seeds))
+        if self.pool is None:
+            self.pool = Pool(processes=processes)
+        graphs = self.pool.starmap(type(self).collect_graph, workers_params)
+        for graph in graphs:
+            self.merge_graph(graph)
+        # Next states that were observed but never expanded have no action-values to back up
+        self.root.partial_value_iteration(queue=[node for node in self.nodes.values() if node.children])
+
+    @classmethod
+    def collect_graph(cls, state, observation, config, episodes, seed):
+        """
+            Run episodes on a new planner, and return the visit statistics of its graph.
+
+        :param state: the initial environment state
+        :param observation: the corresponding state observation
+        :param config: the planner configuration
+        :param episodes: the number of episodes to run
+        :param seed: the planner seed
+        :return: the graph statistics, see get_graph()
+        """
+        planner = cls(state, config)
+        planner.seed(seed)
+        planner.root = planner.get_node(observation, state=state)
+        planner.run_episodes(state, observation, episodes)
+        return planner.get_graph()
+
+    def get_graph(self):
+        """
+            Get the visit statistics of the graph.
+
+        :return: a dict mapping each state to a tuple (observation, N(s), transitions), where transitions maps each
+                 action a to a tuple (N(s,a), [(s', N(s,a,s'), sum of r(s,a,s')) for each visited s'])
+        """
+        return {key: (node.observation, node.count,
+                      {action: (chance_node.count, [(child.observation, child.count, child.cumulative_reward)
+                                                    for child in chance_node.next_nodes if child.count])
+                       for action, chance_node in node.children.items()})
+                for key, node in self.nodes.items()}
+
+    def merge_graph(self, graph):
+        """
+            Add the visit statistics of another graph to this graph.
+
+        :param graph: the graph statistics, see get_graph()
+        """
+        for observation, count, transitions in graph.values():
+            node = self.get_node(observation)
+            node.update(count=count)
+            for action, (chance_count, next_states) in transitions.items():
+                chance_node = node.children[action] if action in node.children else node.add_chance_node(action)
+                chance_node.update(count=chance_count)
+                for next_observation, next_count, next_reward in next_states:
+                    chance_node.get_child(next_observation).update(next_reward, count=next_count)
+
     def reset(self):
-        self.root = self.NODE_TYPE(self, None, None)
         if "horizon" not in self.config:
             budget = max(self.env.action_space.n, self.config["budget"])
             self.config["episodes"], self.config["horizon"] = OLOP.allocation(budget, self.config["gamma"])
+        # Configuration values read in the rollouts and value iteration loops
+        self.gamma = float(self.config["gamma"])
+        self.accuracy = float(self.config["accuracy"])
+        self.horizon = int(self.config["horizon"])
+        self.episodes = int(self.config["episodes"])
+        self.ub_type = self.config["upper_bound"]["type"]
+        # Virtual losses are only needed when several rollouts can be in flight at once
+        concurrent = self.config["threads"] > 1 or self.config["num_parallel_sims"] > 1
+        self.virtual_loss = self.config["virtual_loss"] if concurrent else 0
+        self.recompute_every = self.config["recompute_every"]
+        self.root = self.NODE_TYPE(self, None, None)
 
 
 class StochasticGraphBasedPlannerAgent(GraphBasedPlannerAgent):
@@ -351,6 +762,11 @@ class StochasticGraphBasedPlannerAgent(GraphBasedPlannerAgent):
         cfg = super().default_config()
         cfg.update({
             "max_next_states_count": 1,
+            "processes": 1,
+            "threads": 1,
+            "virtual_loss": 1,
+            "num_parallel_sims": 1,
+            "recompute_every": 4,
             "upper_bound": {
                     "type": "kullback-leibler",
                     "time": "global",
@@ -276,7 +276,7 @@ def binary_search_theta(q_p, f_p, c, eps: float, a: float, b: float = None, max_
     return x
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def theta_func(l, q_p, f_p, c):
     l_m_f_p = l - f_p
     return q_p @ np.log(l_m_f_p) + np.log(q_p @ (1 / l_m_f_p)) - c
@@ -289,6 +289,74 @@ def d_theta_dl_func(l, q_p, f_p):
     return q_l_m_f_p_inv - (q_p @ (l_m_f_p_inv ** 2)) / q_l_m_f_p_inv
 
 
+@jit(nopython=True, cache=True)
+def newton_iteration_theta(q_p, f_p, c, eps, x0, a, weight=0.9, max_iterations=100):
+    """
+        Compiled version of newton_iteration(theta_func, d_theta_dl_func, eps, x0=x0, a=a)
+    """
+    x = np.inf
+    x_next = x0
+    iterations = 0
+    while abs(x - x_next) > eps and iterations < max_iterations:
+        iterations += 1
+        x = x_next
+
+        f_x = theta_func(x, q_p, f_p, c)
+        l_m_f_p_inv = 1 / (x - f_p)
+        q_l_m_f_p_inv = q_p @ l_m_f_p_inv
+        if q_l_m_f_p_inv != 0:
+            df_x = q_l_m_f_p_inv - (q_p @ (l_m_f_p_inv ** 2)) / q_l_m_f_p_inv
+        else:
+            df_x = (f_x - theta_func(x - eps, q_p, f_p, c)) / eps
+        if df_x != 0:
+            x_next = x - f_x / df_x
+
+        if x_next < a:
+            x_next = weight * a + (1 - weight) * x
+
+    if x_next < a:
+        x_next = a
+    return x_next
+
+
+@jit(nopython=True, cache=True)
+def max_expectation_under_constraint_jit(f, q, c, eps):
+    """
+        Compiled version of max_expectation_under_constraint(), for contiguous float64 arrays f and q.
+    """
+    if np.all(q == 0):
+        q = np.ones(q.size) / q.size
+    x_plus = q > 0
+    x_zero = q == 0
+    p_star = np.zeros(q.size)
+    lambda_, z = np.nan, 0.
+
+    q_p = q[x_plus]
+    f_p = f[x_plus]
+    f_star = np.amax(f)
+    if f_star > np.amax(f_p):
+        theta_star = theta_func(f_star, q_p, f_p, c)
+        if theta_star < 0:
+            lambda_ = f_star
+            z = 1 - np.exp(theta_star)
+            f_zero = f[x_zero]
+            p_zero = 1.0 * (f_zero == np.amax(f_zero))
+            p_star[x_zero] = p_zero * z / p_zero.sum()
+    if np.isnan(lambda_):
+        if np.all(np.abs(f_p - f_p[0]) <= 1e-8 + 1e-5 * np.abs(f_p[0])):  # np.isclose(f_p, f_p[0]).all()
+            return q
+        lambda_ = newton_iteration_theta(q_p, f_p, c, eps, f_star + 1, f_star)
+
+    beta = (1 - z) / (q_p @ (1 / (lambda_ - f_p)))
+    if beta == 0:
+        x_uni = x_plus & (f == f_star)
+        if x_uni.sum() > 0:
+            p_star[x_uni] = (1 - z) / x_uni.sum()
+    else:
+        p_star[x_plus] = beta * q_p / (lambda_ - f_p)
+    return p_star
+
+
 def max_expectation_under_constraint(f: np.ndarray, q: np.ndarray, c: float, eps: float = 1e-2,
                                      display: bool = False) -> np.ndarray:
     """
@@ -301,6 +369,10 @@ def max_expectation_under_constraint(f: np.ndarray, q: np.ndarray, c: float, eps
     :param display: plot the function
     :return: the argmax p*
     """
+    if not display:
+        return max_expectation_under_constraint_jit(np.ascontiguousarray(f, dtype=np.float64),
+                                                    np.ascontiguousarray(q, dtype=np.float64),
+                                                    float(c), float(eps))
     np.seterr(all="warn")
     if np.all(q == 0):
         q = np.ones(q.size) / q.size
@@ -0,0 +1,71 @@
+import gym
+import numpy as np
+import pytest
+from gym.envs.toy_text.frozen_lake import FrozenLakeEnv
+from gym.wrappers import TimeLimit
+
+from rl_agents.agents.tree_search.graph_based_stochastic import StochasticGraphBasedPlanner, \
+    StochasticGraphBasedPlannerAgent, threshold_function
+
+
+@pytest.mark.parametrize("expression", ["1*np.log(time)", "0.1 * np.log(time)", "-2.5e-1*np.log(time)",
+                                        "2+3*np.log(time)", "1-0.5*np.log(time)", "np.log(count)*horizon"])
+def test_threshold_function(expression):
+    variables = dict(horizon=3, actions=4, count=7, time=50)
+    expected = eval(expression, dict(np=np), variables)
+    assert threshold_function(expression)(**variables) == pytest.approx(expected)
+
+
+class SnapshotFrozenLakeEnv(FrozenLakeEnv):
+    def get_state(self):
+        return self.s, self.lastaction
+
+    def set_state(self, state):
+        self.s, self.lastaction = state
+
+
+@pytest.mark.parametrize("env", [gym.make("FrozenLake-v1"), TimeLimit(SnapshotFrozenLakeEnv(), max_episode_steps=100)])
+def test_snapshot_restore(env):
+    env.seed(0)
+    env.reset()
+    env.step(2)
+    snapshot = StochasticGraphBasedPlanner._snapshot(env)
+    rollout = StochasticGraphBasedPlanner._restore(snapshot)
+    assert rollout is not env
+    for _ in range(3):
+        assert rollout.unwrapped.s == env.unwrapped.s
+        assert rollout._elapsed_steps == env._elapsed_steps
+        for action in [1, 2, 2]:
+            rollout.step(action)
+        restored = StochasticGraphBasedPlanner._restore(snapshot, rollout)
+        # Only environments providing a way to save their state are restored in place
+        assert (restored is rollout) == isinstance(env.unwrapped, SnapshotFrozenLakeEnv)
+        rollout = restored
+
+
+def check_graph_statistics(planner):
+    for node in planner.nodes.values():
+        for chance_node in node.children.values():
+            assert chance_node.count == chance_node.next_counts.sum()
+            for next_count, next_node in zip(chance_node.next_counts, chance_node.next_nodes):
+                assert next_count == next_node.count
+            assert chance_node.virtual_loss == 0
+
+
+@pytest.mark.parametrize("config", [{}, dict(processes=2), dict(threads=2), dict(num_parallel_sims=3)])
+def test_frozen_lake_8x8(config):
+    env = gym.make("FrozenLake8x8-v1")
+    agent = StochasticGraphBasedPlannerAgent(env, config=dict(budget=200, gamma=0.9, max_next_states_count=3, **config))
+    env.seed(0)
+    agent.seed(0)
+
+    state = env.reset()
+    for _ in range(3):
+        action = agent.act(state)
+        assert action in range(env.action_space.n)
+        assert agent.planner.root.value_lower <= agent.planner.root.value_upper
+        check_graph_statistics(agent.planner)
+
+        state, reward, done, info = env.step(action)
+        if done:
+            state = env.reset()